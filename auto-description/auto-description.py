@@ -4,11 +4,12 @@
 import json
 import re
 import ssl
+import sys
+import time
+from bisect import bisect_left
 from datetime import datetime
 
-import netaddr
 from cvplibrary import CVPGlobalVariables, Device, GlobalVariableNames, RestClient
-from jinja2 import Template
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -22,21 +23,57 @@ OUI28_MASK = 0xFFFFFFF00000
 OUI36_MASK = 0xFFFFFFFFF000
 SECONDS_PER_24H = 86400
 
-OUI_CONFIGLET = "oui.json"
+INTERFACE_PREFIXES = ("Ethernet", "Management")
+INTERFACE_NUMBER_PATTERN = re.compile(r"(\d+)")
+NON_HEX_PATTERN = re.compile(r"[^0-9a-fA-F]")
+# e.g. `00:11:22:33:44:55`, `00-11-22-33-44-55`, `0011.2233.4455`, `001122334455`
+MAC_PATTERN = re.compile(
+    r"^(?:[0-9a-fA-F]{2}([:-])(?:[0-9a-fA-F]{2}\1){4}[0-9a-fA-F]{2}"
+    r"|[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}"
+    r"|[0-9a-fA-F]{12})$"
+)
+
+OUI_CONFIGLET = "oui.txt"
+OUI_STATUS_CONFIGLET = "oui-status.txt"
 VRF_DEFAULT = "default"
 
 # external oui lookup
 EXTERNAL_OUI_LOOKUP = True
+CURL_RETRIES = 3
 CURL_TIMEOUT = 300
+CURL_HEAD_TIMEOUT = 10
 OUI_LIST = "https://gitlab.com/wireshark/wireshark/-/raw/master/manuf"
-OUI_PATTERN = r"^(?P<oui>([0-9A-F]{2}[:]){2,5}([0-9A-F]{2}))(\/\d+)?\s(?P<org>\S+).*$"
-
-TEMPLATE = Template(
-    """\
-interface {{ interface }}
-   description {{ description | upper }}
-"""
-)
+OUI_CHARS = frozenset("0123456789ABCDEFabcdef:")
+OUI_LENGTHS = (8, 11, 14, 17)  # e.g. `00:00:0C` through `00:1B:C5:00:00:00`
+# status configlet lines, e.g. `Checked: 1634256000000`
+OUI_CHECKED = "Checked"
+OUI_LAST_MODIFIED = "Last-Modified"
+OUI_MIN_ENTRIES = 1000  # fewer means a failed or truncated download
+
+TEMPLATE = u"interface {interface}\n   description {description}\n"
+
+
+class OuiTable(object):
+    """OUI-to-organization bindings, held as parallel lists sorted by OUI."""
+
+    def __init__(self, config=""):
+        # `config` holds `OUI<tab>org` lines; sort them, since `lookup` bisects
+        entries = []
+        for line in config.split("\n"):
+            oui, _, org = line.partition("\t")
+            if org:
+                entries.append((int(oui, 16), org))
+        entries.sort()
+        self.ouis = [oui for oui, _ in entries]
+        self.orgs = [org for _, org in entries]
+
+    def lookup(self, mac_address):
+        """Return the organization registered for the longest matching prefix."""
+        for mask in (OUI36_MASK, OUI28_MASK, OUI24_MASK):
+            oui = mac_address & mask
+            index = bisect_left(self.ouis, oui)
+            if index < len(self.ouis) and self.ouis[index] == oui:
+                return self.orgs[index]
 
 
 class DUT(object):
@@ -45,15 +82,17 @@ class DUT(object):
         device_user = CVPGlobalVariables.getValue(GlobalVariableNames.ZTP_USERNAME)
         device_pass = CVPGlobalVariables.getValue(GlobalVariableNames.ZTP_PASSWORD)
         self.device = Device(device_ip, device_user, device_pass)
+        self._oui_db = None
 
     def _run_cmd(self, command):
         """Run a command from the device under test."""
         return self.device.runCmds(["enable", command])[1]["response"]
 
-    def curl(self, url, timeout=CURL_TIMEOUT, vrf=VRF_DEFAULT):
+    def curl(self, url, timeout=CURL_TIMEOUT, vrf=VRF_DEFAULT, options=""):
         """Run a curl command from the device under test."""
-        command = "bash timeout {timeout} {vrf} curl --silent {url}".format(
+        command = "bash timeout {timeout} {vrf} curl --silent {options} {url}".format(
             timeout=timeout,
+            options=options,
             url=url,
             vrf="sudo ip netns exec ns-{vrf}".format(vrf=vrf)
             if vrf != VRF_DEFAULT
@@ -67,68 +106,139 @@ class DUT(object):
     def oui_list(self, vrf=VRF_DEFAULT):
         """Return an up-to-date list of OUI-to-organization bindings."""
 
+        def _last_modified(vrf=VRF_DEFAULT):
+            """Return the `Last-Modified` header of the upstream OUI list."""
+            response = self.curl(
+                url=OUI_LIST, timeout=CURL_HEAD_TIMEOUT, vrf=vrf, options="--head"
+            )
+            if not response:
+                return
+
+            for line in iter_lines(response):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "last-modified":
+                    return value.strip()
+
+        def _status(config):
+            """Return the `name: value` lines of the status configlet."""
+            status = {}
+            for line in iter_lines(config):
+                name, _, value = line.partition(": ")
+                if value:
+                    status[name] = value
+            return status
+
         def _download(vrf=VRF_DEFAULT):
-            """Download and parse the latest OUI list."""
+            """Download and parse the latest OUI list into `OUI<tab>org` lines."""
             db = {}
 
-            response = self.curl(url=OUI_LIST, vrf=vrf)
+            # retries share one CURL_TIMEOUT budget rather than one each
+            deadline = time.time() + CURL_TIMEOUT
+            response = None
+            for attempt in range(CURL_RETRIES):
+                timeout = int(deadline - time.time())
+                if timeout <= 0:
+                    break
+                response = self.curl(url=OUI_LIST, timeout=timeout, vrf=vrf)
+                if response:
+                    break
+                if attempt + 1 < CURL_RETRIES and time.time() < deadline:
+                    time.sleep(2 ** attempt)
             if not response:
-                return db
+                sys.stderr.write("OUI list download failed, keeping cached copy\n")
+                return ""
+
+            for line in iter_lines(response):
+                # e.g. `00:1B:C5:00:00:00/36\tConverg\tConverging Systems Inc.`
+                if not line or line[0] == "#":
+                    continue
+                parts = line.split(None, 2)
+                if len(parts) < 2:
+                    continue
+
+                oui, org = parts[0].split("/")[0], parts[1]
+                if len(oui) not in OUI_LENGTHS or set(oui) - OUI_CHARS:
+                    continue
+
+                # pad to a bare 48-bit address, e.g. `00000C000000`
+                oui = oui.replace(":", "").upper().ljust(12, "0")
+
+                current = db.get(oui)
+                if current is None or current == "IEEERegi":
+                    db[oui] = org
 
-            matches = re.finditer(OUI_PATTERN, response, re.MULTILINE)
-            if not matches:
-                return db
+            if len(db) < OUI_MIN_ENTRIES:
+                sys.stderr.write(
+                    "OUI list has only {} entries, keeping cached copy\n".format(
+                        len(db)
+                    )
+                )
+                return ""
 
-            for match in matches:
-                oui = match.group("oui")
-                if len(oui) == 8:
-                    oui += ":00:00:00"
-                oui = netaddr.EUI(oui)
-                oui.dialect = netaddr.mac_bare
-                oui = str(oui)
+            return "\n".join(oui + "\t" + db[oui] for oui in sorted(db))
 
-                org = match.group("org")
+        if self._oui_db is not None:
+            return self._oui_db
 
-                if oui not in db or db[oui] == "IEEERegi":
-                    db[oui] = org
+        configlet = configlet_get_by_name(OUI_CONFIGLET)
+        status_configlet = configlet_get_by_name(OUI_STATUS_CONFIGLET)
+        key = configlet.get("key")
+        config = configlet.get("config", "")
+        status = _status(status_configlet.get("config", ""))
 
-            return db
-
-        key, timestamp = configlet_exists(OUI_CONFIGLET)
-        update_needed = (not key) or (timestamp and is_24h_old(timestamp))
+        # fall back to the list's own timestamp if no check was recorded
+        checked = int(
+            status.get(OUI_CHECKED) or configlet.get("dateTimeInLongFormat", 0)
+        )
+        update_needed = (not checked) or is_24h_old(checked)
         if update_needed:
-            db = json.dumps(_download(vrf=vrf))
-            if db and not key:
-                configlet_add(configlet_data=db, configlet_name=OUI_CONFIGLET)
-            elif db and key:
-                configlet_update(
+            # skip the download if upstream hasn't changed since the last one;
+            # without a cached list there is nothing to compare against
+            last_modified = _last_modified(vrf=vrf) if key else None
+            unchanged = bool(last_modified) and (
+                status.get(OUI_LAST_MODIFIED) == last_modified
+            )
+            db = "" if unchanged else _download(vrf=vrf)
+            if db:
+                configlet_save(
                     configlet_data=db, configlet_key=key, configlet_name=OUI_CONFIGLET
                 )
-
-        return json.loads(configlet_get(OUI_CONFIGLET))
+                config = db
+
+            # record the check separately so the list itself is only uploaded
+            # when it changes; failed checks are recorded too, so later runs
+            # back off instead of blocking on the download again
+            if not (unchanged or db):
+                last_modified = status.get(OUI_LAST_MODIFIED)
+            lines = [OUI_CHECKED + ": " + str(int(time.time() * 1000))]
+            if last_modified:
+                lines.append(OUI_LAST_MODIFIED + ": " + last_modified)
+            configlet_save(
+                configlet_data="\n".join(lines),
+                configlet_key=status_configlet.get("key"),
+                configlet_name=OUI_STATUS_CONFIGLET,
+            )
+
+        self._oui_db = OuiTable(config)
+        return self._oui_db
 
     def org_from_mac(self, mac_address, vrf=VRF_DEFAULT):
         """Return the registered organization for a given MAC address."""
         org = "Unknown"
-        mac_address = netaddr.EUI(mac_address)
+        hex12 = mac_to_hex12(mac_address)
 
         if EXTERNAL_OUI_LOOKUP:
-            db = self.oui_list(vrf=vrf)
-            for mask in (OUI36_MASK, OUI28_MASK, OUI24_MASK):
-                oui = netaddr.EUI(int(mac_address.bin, 2) & mask)
-                oui.dialect = netaddr.mac_bare
-                oui = str(oui)
-                if oui in db:
-                    org = db[oui]
-                    break
+            org = self.oui_list(vrf=vrf).lookup(int(hex12, 16)) or org
         else:
+            # only needed for the bundled oui database
+            import netaddr
+
             try:
-                org = mac_address.oui.registration().org
+                org = netaddr.EUI(hex12).oui.registration().org
             except netaddr.NotRegisteredError:
                 pass
 
-        mac_address.dialect = netaddr.mac_bare
-        last_six = ":".join(str(mac_address)[-6:][i : i + 2] for i in range(0, 6, 2))
+        last_six = hex12[6:8] + ":" + hex12[8:10] + ":" + hex12[10:12]
         return str(org) + ", " + last_six
 
     def show(self, command):
@@ -140,66 +250,80 @@ def auto_description(dut, interfaces, running_config):
     """Automatically configure interface descriptions based on neighbor device details."""
     vrf = vrf_from_terminattr(running_config)
 
+    # sort naturally, e.g. `Ethernet2/1` before `Ethernet10/1`
+    decorated = [
+        (interface_sort_key(interface["name"]), interface)
+        for interface in interfaces.values()
+    ]
+    decorated.sort(key=lambda x: x[0])
+
+    output = []
     port_channels = set()
-    for interface in sorted(interfaces.values(), key=lambda x: x["name"]):
-        if not interface["name"].startswith("Ethernet") and not interface[
-            "name"
-        ].startswith("Management"):
-            continue
-        config = running_config["interface " + interface["name"]]
-        if "no auto-description" in config["comments"]:
-            continue
+    try:
+        for _, interface in decorated:
+            name = interface["name"]
+            if not name.startswith(INTERFACE_PREFIXES):
+                continue
+            config = running_config["interface " + name]
+            if "no auto-description" in config["comments"]:
+                continue
+
+            description = None
+            if len(interface.get("lldp_neighbors", [])) == 1:
+                neighbor = interface["lldp_neighbors"][0]
+                try:
+                    description = neighbor["systemName"]
+                except KeyError:
+                    description = neighbor["chassisId"]
 
-        description = None
-        if len(interface.get("lldp_neighbors", [])) == 1:
-            neighbor = interface["lldp_neighbors"][0]
-            try:
-                description = neighbor["systemName"]
-            except KeyError:
-                description = neighbor["chassisId"]
-
-            if is_mac(description):
-                description = dut.org_from_mac(description, vrf)
-            else:
-                if (
-                    neighbor["neighborInterfaceInfo"]["interfaceIdType"]
-                    == "interfaceName"
-                ):
-                    neighbor_interface_id = neighbor["neighborInterfaceInfo"][
-                        "interfaceId_v2"
-                    ]
+                if is_mac(description):
+                    description = dut.org_from_mac(description, vrf)
                 else:
-                    neighbor_interface_id = neighbor["neighborInterfaceInfo"][
-                        "interfaceDescription"
-                    ]
-
-                # shorten fqdn to simple hostname
-                description = description.split(".")[0]
-
-                # add description to port-channel if this intf is a member
-                try:
-                    # e.g. `"interfaceMembership": "Member of Port-Channel1"`
-                    port_channel = interface["interfaceMembership"].split(" ")[2]
-                    if port_channel not in port_channels:
-                        print(
-                            TEMPLATE.render(
-                                interface=port_channel, description=description
+                    if (
+                        neighbor["neighborInterfaceInfo"]["interfaceIdType"]
+                        == "interfaceName"
+                    ):
+                        neighbor_interface_id = neighbor["neighborInterfaceInfo"][
+                            "interfaceId_v2"
+                        ]
+                    else:
+                        neighbor_interface_id = neighbor["neighborInterfaceInfo"][
+                            "interfaceDescription"
+                        ]
+
+                    # shorten fqdn to simple hostname
+                    description = description.split(".")[0]
+
+                    # add description to port-channel if this intf is a member
+                    try:
+                        # e.g. `"interfaceMembership": "Member of Port-Channel1"`
+                        port_channel = interface["interfaceMembership"].split(" ")[2]
+                        if port_channel not in port_channels:
+                            output.append(
+                                TEMPLATE.format(
+                                    interface=port_channel,
+                                    description=description.upper(),
+                                )
                             )
-                        )
-                    port_channels.add(port_channel)
-                except KeyError:
-                    pass
+                        port_channels.add(port_channel)
+                    except KeyError:
+                        pass
 
-                # add neighbor intf to description
-                description += ", " + neighbor_interface_id
+                    # add neighbor intf to description
+                    description += ", " + neighbor_interface_id
 
-        # otherwise, try to determine vendor from mac oui
-        elif len(interface.get("mac_address_table", [])) == 1:
-            mac_address = interface["mac_address_table"][0]["macAddress"]
-            description = dut.org_from_mac(mac_address, vrf)
+            # otherwise, try to determine vendor from mac oui
+            elif len(interface.get("mac_address_table", [])) == 1:
+                mac_address = interface["mac_address_table"][0]["macAddress"]
+                description = dut.org_from_mac(mac_address, vrf)
 
-        if description:
-            print(TEMPLATE.render(interface=interface["name"], description=description))
+            if description:
+                output.append(
+                    TEMPLATE.format(interface=name, description=description.upper())
+                )
+    finally:
+        # keep whatever was rendered if a later interface fails
+        sys.stdout.write("".join(output))
 
 
 def configlet_add(configlet_data, configlet_name):
@@ -208,31 +332,28 @@ def configlet_add(configlet_data, configlet_name):
         "config": configlet_data,
         "name": configlet_name,
     }
-    client = RestClient(CVP_URL + CVP_ADD_CONFIGLET, "POST")
-    client.setRawData(json.dumps(data))
-    if client.connect():
-        response = json.loads(client.getResponse())
+    response = cvp_request(CVP_ADD_CONFIGLET, "POST", data)
+    if response is not None:
         return not response.get("errorCode")
 
 
-def configlet_exists(configlet_name):
+def configlet_get_by_name(configlet_name):
     """This API is used to get a configlet by its name."""
-    client = RestClient(CVP_URL + CVP_GET_CONFIGLET_BY_NAME + configlet_name, "GET")
-    if client.connect():
-        response = json.loads(client.getResponse())
-        if "errorCode" not in response:
-            return response["key"], response["dateTimeInLongFormat"]
-    return False, 0
-
-
-def configlet_get(configlet_name):
-    """This API is used to get a configlet by its name."""
-    client = RestClient(CVP_URL + CVP_GET_CONFIGLET_BY_NAME + configlet_name, "GET")
-    if client.connect():
-        response = json.loads(client.getResponse())
-        if "errorCode" not in response:
-            return response["config"]
-    return "{}"
+    response = cvp_request(CVP_GET_CONFIGLET_BY_NAME + configlet_name, "GET")
+    if response is None or "errorCode" in response:
+        return {}
+    return response
+
+
+def configlet_save(configlet_data, configlet_key, configlet_name):
+    """Add a configlet, or update it if it already exists."""
+    if configlet_key:
+        return configlet_update(
+            configlet_data=configlet_data,
+            configlet_key=configlet_key,
+            configlet_name=configlet_name,
+        )
+    return configlet_add(configlet_data=configlet_data, configlet_name=configlet_name)
 
 
 def configlet_update(configlet_data, configlet_key, configlet_name):
@@ -244,13 +365,28 @@ def configlet_update(configlet_data, configlet_key, configlet_name):
         "waitForTaskIds": False,
         "reconciled": False,
     }
-    client = RestClient(CVP_URL + CVP_UPDATE_CONFIGLET, "POST")
-    client.setRawData(json.dumps(data))
-    if client.connect():
-        response = json.loads(client.getResponse())
+    response = cvp_request(CVP_UPDATE_CONFIGLET, "POST", data)
+    if response is not None:
         return not response.get("errorCode")
 
 
+def cvp_request(path, method, data=None):
+    """Send a request to the CVP REST API and return the decoded response."""
+    client = RestClient(CVP_URL + path, method)
+    if data is not None:
+        client.setRawData(json.dumps(data))
+    if client.connect():
+        return json.loads(client.getResponse())
+
+
+def interface_sort_key(interface_name):
+    """Return a key that sorts interface names by their numeric components."""
+    return [
+        int(part) if part.isdigit() else part
+        for part in INTERFACE_NUMBER_PATTERN.split(interface_name)
+    ]
+
+
 def is_24h_old(timestamp):
     """Returns true if the provided timestamp is more than 24 hours old, false otherwise."""
     return (
@@ -260,52 +396,57 @@ def is_24h_old(timestamp):
 
 def is_mac(mac_address):
     """Returns true if the provided string is a valid MAC address, false otherwise."""
-    try:
-        netaddr.EUI(mac_address)
-        return True
-    except netaddr.AddrFormatError:
-        return False
+    return bool(MAC_PATTERN.match(mac_address))
+
+
+def iter_lines(text):
+    """Yield the lines of a string one at a time, without building a list of them."""
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
 
 
 def lldp_neighbors_to_interfaces(interfaces, lldp_neighbors):
     """Add LLDP neighbors to the corresponding interface."""
-    for interface in lldp_neighbors:
-        try:
-            interfaces[interface]["lldp_neighbors"] = lldp_neighbors[interface][
-                "lldpNeighborInfo"
-            ]
-        except KeyError:
+    for name, neighbors in lldp_neighbors.items():
+        interface = interfaces.get(name)
+        if interface is None or "lldpNeighborInfo" not in neighbors:
             continue
+        interface["lldp_neighbors"] = neighbors["lldpNeighborInfo"]
 
 
-def mac_address_table_to_interfaces(interfaces, mac_address_table):
+def mac_address_table_to_interfaces(interfaces, mac_address_table, allowed=None):
     """Add MAC address table entries to the corresponding interface."""
     for mac_address in mac_address_table:
-        try:
-            interfaces[mac_address["interface"]].setdefault(
-                "mac_address_table", []
-            ).append(mac_address)
-        except KeyError:
+        name = mac_address.get("interface")
+        if allowed is not None and name not in allowed:
+            continue
+        interface = interfaces.get(name)
+        if interface is None:
             continue
+        interface.setdefault("mac_address_table", []).append(mac_address)
+
+
+def mac_to_hex12(mac_address):
+    """Normalize a MAC address to 12 uppercase hex digits, e.g. `001122334455`."""
+    return NON_HEX_PATTERN.sub("", mac_address).upper().zfill(12)[:12]
 
 
 def vrf_from_terminattr(running_config):
     """Determine the internet-facing VRF from the device's TerminAttr config."""
     # e.g. `"exec /usr/bin/TerminAttr -cvvrf=MGMT": null,`
-    vrf = VRF_DEFAULT
-    try:
-        args = next(
-            key
-            for key in running_config.get("daemon TerminAttr", {})["cmds"].keys()
-            if "exec" in key
-        ).split(" ")
-    except (KeyError, StopIteration):
-        return vrf
-    for arg in args:
-        if not arg.startswith("-cvvrf"):
+    for key in running_config.get("daemon TerminAttr", {}).get("cmds", {}):
+        if not key.startswith("exec "):
+            continue
+        index = key.find("-cvvrf=")
+        if index == -1:
             continue
-        vrf = arg.split("=")[1]
-    return vrf
+        return key[index + len("-cvvrf=") :].partition(" ")[0]
+    return VRF_DEFAULT
 
 
 def main():
@@ -317,7 +458,8 @@ def main():
     running_config = dut.show("running-config")["cmds"]
 
     lldp_neighbors_to_interfaces(interfaces, lldp_neighbors)
-    mac_address_table_to_interfaces(interfaces, mac_address_table)
+    allowed = {name for name in interfaces if name.startswith(INTERFACE_PREFIXES)}
+    mac_address_table_to_interfaces(interfaces, mac_address_table, allowed)
     auto_description(dut, interfaces, running_config)
 
 